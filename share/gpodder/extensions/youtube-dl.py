@@ -4,16 +4,21 @@
 # (c) 2019-08-17 Eric Le Lay <elelay.fr:contact>
 # Released under the same license terms as gPodder itself.
 
+import collections
+import contextlib
 import logging
 import os
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
 
 import youtube_dl
 from youtube_dl.utils import DownloadError, sanitize_url
 
 import gpodder
-from gpodder import download, feedcore, model, registry, youtube
+from gpodder import download, feedcore, model, registry, util, youtube
 from gpodder.util import mimetype_from_extension, remove_html_tags
 
 _ = gpodder.gettext
@@ -41,6 +46,31 @@ DefaultConfig = {
 # youtube feed still preprocessed by youtube.py (compat)
 CHANNEL_RE = re.compile(r'''https://www.youtube.com/feeds/videos.xml\?channel_id=(.+)''')
 PLAYLIST_RE = re.compile(r'''https://www.youtube.com/feeds/videos.xml\?playlist_id=(.+)''')
+WATCH_RE = re.compile(r'''https://www\.youtube\.com/watch\?v=.+''')
+
+# number of videos fetched in parallel when refreshing a channel.
+# Keep it small so youtube doesn't throttle us.
+REFRESH_WORKERS = 4
+
+# ETag and Last-Modified values stored by this extension start with youtube-dl: to tell them
+# apart from the ones left by the plain feed fetcher for the same videos.xml url, or with
+# youtube-dl[N]: when youtube-dl stopped listing the channel at max_episodes=N.
+VALIDATOR_RE = re.compile(r'''youtube-dl(?:\[(\d+)\])?:(.*)''', re.DOTALL)
+
+# channel cover and description rarely change: only fetch them once a day
+CHANNEL_INFO_TTL = 24 * 60 * 60
+
+# formats not requiring the DASH manifest: youtube.py's non-DASH itags and youtube-dl's
+# best/worst, which only select formats with both audio and video
+NON_DASH_FORMATS = {str(fmt) for fmt in youtube.formats_dict} | {'best', 'worst'}
+
+# hyperlinks in video descriptions
+URL_SUB_RE = re.compile(r'''https?://[^\s]+''')
+
+# static prefix of every episode html description
+HTML_STYLE_PREFIX = ('<style type="text/css">'
+                     'body > img { float: left; max-width: 30vw; margin: 0 1em 1em 0; }'
+                     '</style>')
 
 
 def youtube_parsedate(s):
@@ -50,10 +80,35 @@ def youtube_parsedate(s):
     parsed with this function (20170920).
     """
     if s:
-        return time.mktime(time.strptime(s, "%Y%m%d"))
+        # slicing is much faster than time.strptime(s, "%Y%m%d")
+        return time.mktime((int(s[0:4]), int(s[4:6]), int(s[6:8]), 0, 0, 0, 0, 0, -1))
     return 0
 
 
+def wrap_validator(value, truncated_at=None):
+    """ :return str: ETag or Last-Modified to store, see VALIDATOR_RE """
+    if truncated_at is None:
+        return 'youtube-dl:' + value
+    return 'youtube-dl[{}]:{}'.format(truncated_at, value)
+
+
+def unwrap_validator(value):
+    """
+    :return (str, int): ETag or Last-Modified stored by this extension,
+                        '' if videos.xml didn't provide it, None if not stored by this extension;
+                        max_episodes youtube-dl stopped listing the channel at, None if it listed it all
+    """
+    m = VALIDATOR_RE.match(value or '')
+    if m is None:
+        return None, None
+    return m.group(2), int(m.group(1)) if m.group(1) else None
+
+
+def entry_is_refreshed(entry):
+    """ :return bool: True if youtube-dl already extracted the video page of entry """
+    return bool(entry.get('webpage_url'))
+
+
 def video_guid(video_id):
     """
     generate same guid as youtube
@@ -88,15 +143,16 @@ class YoutubeCustomDownload(download.CustomDownload):
                 headers['content-type'] = ext_filetype
             # See #673 when merging multiple formats, the extension is appended to the tempname
             # by YoutubeDL resulting in empty .partial file + .partial.mp4 exists
-            tempstat = os.stat(tempname)
-            if not tempstat.st_size:
-                tempname_with_ext = tempname + dot_ext
-                if os.path.isfile(tempname_with_ext):
-                    logger.debug('Youtubedl downloaded to %s instead of %s, moving',
-                                 os.path.basename(tempname),
-                                 os.path.basename(tempname_with_ext))
-                    os.remove(tempname)
-                    os.rename(tempname_with_ext, tempname)
+            if len(res.get('requested_formats') or ()) > 1:
+                tempstat = os.stat(tempname)
+                if not tempstat.st_size:
+                    tempname_with_ext = tempname + dot_ext
+                    if os.path.isfile(tempname_with_ext):
+                        logger.debug('Youtubedl downloaded to %s instead of %s, moving',
+                                     os.path.basename(tempname),
+                                     os.path.basename(tempname_with_ext))
+                        os.remove(tempname)
+                        os.rename(tempname_with_ext, tempname)
         return headers, res.get('url', self._url)
 
     def _my_hook(self, d):
@@ -122,34 +178,39 @@ class YoutubeFeed(model.Feed):
     """
     Represents the youtube feed for model.PodcastChannel
     """
-    def __init__(self, url, cover_url, description, max_episodes, ie_result, downloader):
+    def __init__(self, url, cover_url, description, max_episodes, ie_result, downloader,
+                 http_etag=None, http_last_modified=None):
         self._url = url
         self._cover_url = cover_url
         self._description = description
         self._max_episodes = max_episodes
+        self._http_etag = http_etag
+        self._http_last_modified = http_last_modified
+        self._has_unrefreshed_entries = False
+        self._truncated_at = None  # max_episodes, when entries were not all listed
         ie_result['entries'] = self._process_entries(ie_result.get('entries', []))
         self._ie_result = ie_result
         self._downloader = downloader
 
     def _process_entries(self, entries):
-        filtered_entries = []
-        seen_guids = set()
-        for i, e in enumerate(entries):  # consumes the generator!
+        # guid -> entry, in youtube order (decreasing date)
+        filtered_entries = collections.OrderedDict()
+        for e in entries:  # consumes the generator!
             if e.get('_type', 'video') == 'url' and e.get('ie_key') == 'Youtube':
                 guid = video_guid(e['id'])
                 e['guid'] = guid
-                if guid in seen_guids:
+                if guid in filtered_entries:
                     logger.debug('dropping already seen entry %s title="%s"', guid, e.get('title'))
                 else:
-                    filtered_entries.append(e)
-                    seen_guids.add(guid)
+                    filtered_entries[guid] = e
             else:
                 logger.debug('dropping entry not youtube video %r', e)
-            if len(filtered_entries) == self._max_episodes:
+            if self._max_episodes and len(filtered_entries) == self._max_episodes:
                 # entries is a generator: stopping now prevents it to download more pages
                 logger.debug('stopping entry enumeration')
+                self._truncated_at = self._max_episodes
                 break
-        return filtered_entries
+        return list(filtered_entries.values())
 
     def get_title(self):
         return '{} (Youtube)'.format(self._ie_result.get('title') or self._ie_result.get('id') or self._url)
@@ -165,22 +226,32 @@ class YoutubeFeed(model.Feed):
 
     def get_http_etag(self):
         """ :return str: optional -- last HTTP etag header, for conditional request next time """
-        # youtube-dl doesn't provide it!
-        return None
+        # youtube-dl doesn't provide it, it comes from the videos.xml feed
+        if self._http_etag is None or self._has_unrefreshed_entries:
+            return None
+        return wrap_validator(self._http_etag, self._truncated_at)
 
     def get_http_last_modified(self):
         """ :return str: optional -- last HTTP Last-Modified header, for conditional request next time """
-        # youtube-dl doesn't provide it!
-        return None
+        # youtube-dl doesn't provide it, it comes from the videos.xml feed
+        if self._http_last_modified is None or self._has_unrefreshed_entries:
+            return None
+        return wrap_validator(self._http_last_modified, self._truncated_at)
 
     def get_new_episodes(self, channel, existing_guids):
+        # model.PodcastChannel passes a guid->episode dict, but make sure
+        # membership tests below stay O(1) whatever container we get
+        if not isinstance(existing_guids, (dict, set, frozenset)):
+            existing_guids = set(existing_guids)
         # entries are already sorted by decreasing date
-        # trim guids to max episodes
-        entries = [e for i, e in enumerate(self._ie_result['entries'])
-                   if not self._max_episodes or i < self._max_episodes]
-        all_seen_guids = set(e['guid'] for e in entries)
-        # only fetch new ones from youtube since they are so slow to get
-        new_entries = [e for e in entries if e['guid'] not in existing_guids]
+        # and trimmed to max episodes by _process_entries
+        all_seen_guids = set()
+        new_entries = []
+        for e in self._ie_result['entries']:
+            all_seen_guids.add(e['guid'])
+            # only fetch new ones from youtube since they are so slow to get
+            if e['guid'] not in existing_guids:
+                new_entries.append(e)
         logger.debug('%i/%i new entries', len(new_entries), len(all_seen_guids))
         self._ie_result['entries'] = new_entries
         self._downloader.refresh_entries(self._ie_result, self._max_episodes)
@@ -188,6 +259,13 @@ class YoutubeFeed(model.Feed):
         episodes = []
         for en in self._ie_result['entries']:
             guid = video_guid(en['id'])
+            if not entry_is_refreshed(en):
+                # refresh_entries failed for this one: don't waste time building an
+                # episode without url. Don't store the new validators either,
+                # so that next refresh isn't NOT_MODIFIED and retries it.
+                logger.debug('skipping unrefreshed entry %s title="%s"', guid, en.get('title'))
+                self._has_unrefreshed_entries = True
+                continue
             description = remove_html_tags(en.get('description') or _('No description available'))
             html_description = self.nice_html_description(en, description)
             if en.get('ext'):
@@ -197,8 +275,12 @@ class YoutubeFeed(model.Feed):
             if en.get('filesize'):
                 filesize = int(en['filesize'] or 0)
             else:
-                filesize = sum(int(f.get('filesize') or 0)
-                               for f in en.get('requested_formats', []))
+                # youtube-dl already provides ints
+                filesize = 0
+                for f in en.get('requested_formats') or ():
+                    fs = f.get('filesize')
+                    if fs:
+                        filesize += fs
             ep = {
                 'title': en.get('title', guid),
                 'link': en.get('webpage_url'),
@@ -231,19 +313,17 @@ class YoutubeFeed(model.Feed):
         """
         basic html formating + hyperlink highlighting + video thumbnail
         """
-        description = re.sub(r'''https?://[^\s]+''',
-                             r'''<a href="\g<0>">\g<0></a>''',
-                             description)
-        description = description.replace('\n', '<br>')
-        html = """<style type="text/css">
-        body > img { float: left; max-width: 30vw; margin: 0 1em 1em 0; }
-        </style>
-        """
+        # substring checks are much cheaper than a regex scan of the whole description
+        if 'http' in description:
+            description = URL_SUB_RE.sub(r'''<a href="\g<0>">\g<0></a>''', description)
+        if '\n' in description:
+            description = description.replace('\n', '<br>')
+        parts = [HTML_STYLE_PREFIX]
         img = en.get('thumbnail')
         if img:
-            html += '<img src="{}">'.format(img)
-        html += '<p>{}</p>'.format(description)
-        return html
+            parts.append('<img src="{}">'.format(img))
+        parts.append('<p>{}</p>'.format(description))
+        return ''.join(parts)
 
 
 class gPodderYoutubeDL(download.CustomDownloader):
@@ -256,6 +336,16 @@ class gPodderYoutubeDL(download.CustomDownloader):
             'cachedir': cachedir,
             'no_color': True,  # prevent escape codes in desktop notifications on errors
         }
+        # YoutubeDL instances are costly to create (they load all extractors), so the ones
+        # used to refresh channels are kept between refreshes. They are not thread-safe:
+        # each one is borrowed by a single thread at a time (see _borrowed_ydl).
+        self._ydl_lock = threading.Lock()
+        self._idle_refresh_ydls = []  # list channel/playlist contents
+        self._idle_entries_ydls = []  # fetch video metadata
+        self._closed = False
+        # channel_url -> (value, expiration timestamp)
+        self._cover_cache = {}
+        self._desc_cache = {}
 
     def add_format(self, gpodder_config, opts, fallback=None):
         """ construct youtube-dl -f argument from configured format. """
@@ -269,19 +359,21 @@ class gPodderYoutubeDL(download.CustomDownloader):
         # See https://github.com/ytdl-org/youtube-dl#format-selection for details
         # about youtube-dl format specification.
         fmt_ids = youtube.get_fmt_ids(gpodder_config.youtube)
-        opts['format'] = '/'.join(str(fmt) for fmt in fmt_ids)
         if fallback:
-            opts['format'] += '/' + fallback
+            fmt_ids = list(fmt_ids) + [fallback]
+        opts['format'] = '/'.join(map(str, fmt_ids))
 
     def fetch_video(self, url, tempname, reporthook):
         opts = {
             'outtmpl': tempname,  # use given tempname by DownloadTask
             'nopart': True,  # don't append .part (already .partial)
             'retries': 3,  # retry a few times
-            'progress_hooks': [reporthook]  # to notify UI
+            'progress_hooks': [reporthook],  # to notify UI
+            **self._ydl_opts
         }
-        opts.update(self._ydl_opts)
         self.add_format(self.gpodder_config, opts)
+        if all(fmt in NON_DASH_FORMATS for fmt in opts['format'].split('/')):
+            opts['youtube_include_dash_manifest'] = False  # no need to download and parse it
         with youtube_dl.YoutubeDL(opts) as ydl:
             return ydl.extract_info(url, download=True)
 
@@ -290,21 +382,106 @@ class gPodderYoutubeDL(download.CustomDownloader):
         opts = {
             'skip_download': True,  # don't download the video
             'youtube_include_dash_manifest': False,  # don't download the DASH manifest
+            **self._ydl_opts
         }
         self.add_format(self.gpodder_config, opts, fallback='18')
-        opts.update(self._ydl_opts)
+        entries = ie_result['entries']
+        if not entries:
+            return
+        # Each video page is fetched and parsed separately, which is slow:
+        # process entries in parallel, each worker with its own YoutubeDL
+        # since they are not thread-safe.
+        workers = min(REFRESH_WORKERS, len(entries))
+        chunks = [entries[w::workers] for w in range(workers)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda chunk: self._refresh_chunk(opts, chunk), chunks)
+            for w, refreshed in enumerate(results):
+                entries[w::workers] = refreshed
+
+    def _refresh_chunk(self, opts, entries):
+        refreshed = []
+        with self._borrowed_ydl(self._idle_entries_ydls, opts) as ydl:
+            # preferred formats may have changed since the instance was created
+            ydl.params['format'] = opts['format']
+            for e in entries:
+                try:
+                    refreshed.append(ydl.process_ie_result(e, download=False))
+                except DownloadError:
+                    # keep the unprocessed entry so the others still get refreshed
+                    logger.exception('refreshing %r', e)
+                    refreshed.append(e)
+        return refreshed
+
+    @contextlib.contextmanager
+    def _borrowed_ydl(self, idle_ydls, opts):
+        """
+        Borrow an idle YoutubeDL from idle_ydls, or a new one created with opts if none is idle.
+        It's given back to idle_ydls afterwards, for the next refresh.
+        """
+        with self._ydl_lock:
+            ydl = idle_ydls.pop() if idle_ydls else None
+        if ydl is None:
+            ydl = youtube_dl.YoutubeDL(opts)
         try:
-            with youtube_dl.YoutubeDL(opts) as ydl:
-                ydl.process_ie_result(ie_result, download=False)
-        except DownloadError:
-            logger.exception('refreshing %r', ie_result)
+            yield ydl
+        finally:
+            with self._ydl_lock:
+                closed = self._closed
+                if not closed:
+                    idle_ydls.append(ydl)
+            if closed:
+                ydl.__exit__(None, None, None)
+
+    def close(self):
+        """ release the YoutubeDL instances kept between refreshes """
+        with self._ydl_lock:
+            self._closed = True
+            ydls = self._idle_refresh_ydls + self._idle_entries_ydls
+            self._idle_refresh_ydls.clear()
+            self._idle_entries_ydls.clear()
+        for ydl in ydls:
+            ydl.__exit__(None, None, None)
+
+    def check_modified(self, channel_url, etag, modified):
+        """
+        Conditional GET of the channel's videos.xml feed.
 
-    def refresh(self, url, channel_url, max_episodes):
+        youtube-dl doesn't support conditional requests, so we ask youtube ourselves
+        whether the channel changed since last time.
+        :return (bool, str, str): modified, new etag, new last-modified
+                                  ('' when not provided by youtube)
+        """
+        headers = {}
+        if modified:
+            headers['If-Modified-Since'] = modified
+        if etag:
+            headers['If-None-Match'] = etag
+        try:
+            with util.urlopen(channel_url, headers) as stream:
+                return True, stream.headers.get('etag', ''), stream.headers.get('last-modified', '')
+        except HTTPError as e:
+            if e.code == 304:
+                return False, etag, modified
+            logger.warning('checking %s for modifications: %r', channel_url, e)
+        except Exception:
+            logger.warning('checking %s for modifications', channel_url, exc_info=True)
+        # let youtube-dl handle (and report) the error, keeping previous validators
+        return True, etag, modified
+
+    def refresh(self, url, channel_url, max_episodes, etag=None, modified=None, conditional=False):
         """
         Fetch a channel or playlist contents.
 
         Doesn't yet fetch video entry informations, so we only get the video id and title.
+        :param str etag, modified: validators of the previous videos.xml response
+        :param bool conditional: don't run youtube-dl if videos.xml is not modified
         """
+        if conditional:
+            is_modified, etag, modified = self.check_modified(channel_url, etag, modified)
+            if not is_modified:
+                logger.debug('%s not modified, skipping youtube-dl', channel_url)
+                return feedcore.Result(feedcore.NOT_MODIFIED, None)
+
         # Duplicate a bit of the YoutubeDL machinery here because we only
         # want to parse the channel/playlist first, not to fetch video entries.
         # We call YoutubeDL.extract_info(process=False), so we
@@ -318,9 +495,9 @@ class gPodderYoutubeDL(download.CustomDownloader):
 
         opts = {
             'youtube_include_dash_manifest': False,  # only interested in video title and id
+            **self._ydl_opts
         }
-        opts.update(self._ydl_opts)
-        with youtube_dl.YoutubeDL(opts) as ydl:
+        with self._borrowed_ydl(self._idle_refresh_ydls, opts) as ydl:
             ie_result = ydl.extract_info(url, download=False, process=False)
             result_type, has_playlist = extract_type(ie_result)
             while not has_playlist:
@@ -335,10 +512,27 @@ class gPodderYoutubeDL(download.CustomDownloader):
                                                  process=False,
                                                  ie_key=ie_result.get('ie_key'))
                 result_type, has_playlist = extract_type(ie_result)
-        cover_url = youtube.get_cover(channel_url)  # youtube-dl doesn't provide the cover url!
-        description = youtube.get_channel_desc(channel_url)  # youtube-dl doesn't provide the description!
-        return feedcore.Result(feedcore.UPDATED_FEED,
-            YoutubeFeed(url, cover_url, description, max_episodes, ie_result, self))
+            # youtube-dl doesn't provide the cover url nor the description!
+            # Only scrape them once youtube-dl could list the channel.
+            cover_url = self._get_channel_info(self._cover_cache, youtube.get_cover, channel_url)
+            description = self._get_channel_info(self._desc_cache, youtube.get_channel_desc, channel_url)
+            # entries is a generator still using ydl: consume it while we have it
+            feed = YoutubeFeed(url, cover_url, description, max_episodes, ie_result, self,
+                               http_etag=etag, http_last_modified=modified)
+        return feedcore.Result(feedcore.UPDATED_FEED, feed)
+
+    @staticmethod
+    def _get_channel_info(cache, fetch, channel_url):
+        """ :return: fetch(channel_url), cached for CHANNEL_INFO_TTL seconds """
+        now = time.time()
+        value, expires = cache.get(channel_url, (None, 0))
+        if expires < now:
+            new_value = fetch(channel_url)
+            if new_value is not None:
+                cache[channel_url] = (new_value, now + CHANNEL_INFO_TTL)
+                value = new_value
+            # else keep previous value if any and retry next time
+        return value
 
     def fetch_channel(self, channel, max_episodes=0):
         """
@@ -355,16 +549,29 @@ class gPodderYoutubeDL(download.CustomDownloader):
                 url = 'https://www.youtube.com/playlist?list={}'.format(m.group(1))
         if url:
             logger.info('Youtube-dl Handling %s => %s', channel.url, url)
-            return self.refresh(url, channel.url, max_episodes)
+            etag, truncated_at = unwrap_validator(channel.http_etag)
+            modified, modified_truncated_at = unwrap_validator(channel.http_last_modified)
+            if etag is None:
+                truncated_at = modified_truncated_at
+            if etag == '' and modified == '':
+                # videos.xml didn't provide validators last time: checking it is a wasted request
+                conditional = False
+            elif truncated_at is not None and (not max_episodes or max_episodes > truncated_at):
+                # last listing stopped before the end of the channel and more episodes are wanted now:
+                # videos.xml only lists the latest videos, let youtube-dl fetch older ones
+                conditional = False
+            else:
+                conditional = True
+            return self.refresh(url, channel.url, max_episodes, etag, modified, conditional)
         return None
 
     def custom_downloader(self, unused_config, episode):
         """
         called from registry.custom_downloader.resolve
         """
-        if re.match(r'''https://www.youtube.com/watch\?v=.+''', episode.url):
+        if WATCH_RE.match(episode.url):
             return YoutubeCustomDownload(self, episode.url)
-        elif re.match(r'''https://www.youtube.com/watch\?v=.+''', episode.link):
+        elif WATCH_RE.match(episode.link):
             return YoutubeCustomDownload(self, episode.link)
         return None
 
@@ -391,3 +598,4 @@ class gPodderExtension:
             registry.custom_downloader.unregister(self.ytdl.custom_downloader)
         except ValueError:
             pass
+        self.ytdl.close()
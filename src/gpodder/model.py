@@ -1024,10 +1024,6 @@ class PodcastChannel(PodcastModelObject):
                                feed.get_cover_url() or None,
                                feed.get_payment_url() or None)
 
-        # Update values for HTTP conditional requests
-        self.http_etag = feed.get_http_etag() or self.http_etag
-        self.http_last_modified = feed.get_http_last_modified() or self.http_last_modified
-
         # Load all episodes to update them properly.
         existing = self.get_all_episodes()
         # GUID-based existing episode list
@@ -1074,6 +1070,11 @@ class PodcastChannel(PodcastModelObject):
             else:
                 next_feed = None
 
+        # Update values for HTTP conditional requests
+        # (after getting new episodes: custom feeds may withhold them if some episodes failed)
+        self.http_etag = feed.get_http_etag() or self.http_etag
+        self.http_last_modified = feed.get_http_last_modified() or self.http_last_modified
+
         # mark episodes not new
         real_new_episode_count = 0
         # Search all entries for new episodes
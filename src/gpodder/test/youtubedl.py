@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# gPodder - A media aggregator and podcast client
+# Copyright (c) 2005-2018 The gPodder Team
+#
+# gPodder is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# gPodder is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# gpodder.test.youtubedl - Unit tests for the youtube-dl extension
+
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from urllib.error import HTTPError, URLError
+
+import gpodder
+from gpodder import util
+
+try:
+    import youtube_dl
+except ImportError:
+    youtube_dl = None
+
+EXTENSION_FILE = os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                              'share', 'gpodder', 'extensions', 'youtube-dl.py')
+
+CHANNEL_URL = 'https://www.youtube.com/feeds/videos.xml?channel_id=UCxyz'
+
+
+def load_extension():
+    spec = importlib.util.spec_from_file_location('gpodder_extensions_youtube_dl', EXTENSION_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@unittest.skipIf(youtube_dl is None, 'youtube_dl is not installed')
+@unittest.skipUnless(os.path.isfile(EXTENSION_FILE), 'youtube-dl extension not found (installed copy?)')
+class YoutubeDLTestCase(unittest.TestCase):
+    """ Loads the extension, with gpodder.home in a temporary directory """
+    def setUp(self):
+        self.ext = load_extension()
+        self.old_home = gpodder.home
+        gpodder.home = tempfile.mkdtemp()
+        config = mock.Mock()
+        config.youtube.preferred_fmt_ids = ['18']
+        self.ytdl = self.ext.gPodderYoutubeDL(config)
+
+    def tearDown(self):
+        shutil.rmtree(gpodder.home)
+        gpodder.home = self.old_home
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class TestYoutubeDLConditionalRefresh(YoutubeDLTestCase):
+    def test_not_modified(self):
+        error = HTTPError(CHANNEL_URL, 304, 'Not Modified', {}, None)
+        with mock.patch.object(util, 'urlopen', side_effect=error) as urlopen:
+            res = self.ytdl.check_modified(CHANNEL_URL, '"etag"', 'Mon, 01 Jun 2020 00:00:00 GMT')
+        self.assertEqual(res, (False, '"etag"', 'Mon, 01 Jun 2020 00:00:00 GMT'))
+        urlopen.assert_called_once_with(CHANNEL_URL, {
+            'If-None-Match': '"etag"',
+            'If-Modified-Since': 'Mon, 01 Jun 2020 00:00:00 GMT',
+        })
+
+    def test_modified(self):
+        response = FakeResponse({'etag': '"new"', 'last-modified': 'Tue, 02 Jun 2020 00:00:00 GMT'})
+        with mock.patch.object(util, 'urlopen', return_value=response):
+            res = self.ytdl.check_modified(CHANNEL_URL, '"etag"', None)
+        self.assertEqual(res, (True, '"new"', 'Tue, 02 Jun 2020 00:00:00 GMT'))
+
+    def test_modified_without_validators(self):
+        with mock.patch.object(util, 'urlopen', return_value=FakeResponse({})) as urlopen:
+            res = self.ytdl.check_modified(CHANNEL_URL, None, None)
+        self.assertEqual(res, (True, '', ''))
+        urlopen.assert_called_once_with(CHANNEL_URL, {})
+
+    def test_http_error_keeps_validators(self):
+        error = HTTPError(CHANNEL_URL, 500, 'Internal Server Error', {}, None)
+        with mock.patch.object(util, 'urlopen', side_effect=error):
+            res = self.ytdl.check_modified(CHANNEL_URL, '"etag"', None)
+        self.assertEqual(res, (True, '"etag"', None))
+
+    def test_network_error_keeps_validators(self):
+        with mock.patch.object(util, 'urlopen', side_effect=URLError('offline')):
+            res = self.ytdl.check_modified(CHANNEL_URL, None, 'Mon, 01 Jun 2020 00:00:00 GMT')
+        self.assertEqual(res, (True, None, 'Mon, 01 Jun 2020 00:00:00 GMT'))
+
+    def test_unwrap_validator(self):
+        self.assertEqual(self.ext.unwrap_validator('youtube-dl:"abc"'), ('"abc"', None))
+        self.assertEqual(self.ext.unwrap_validator('youtube-dl[200]:"abc"'), ('"abc"', 200))
+        self.assertEqual(self.ext.unwrap_validator('youtube-dl:'), ('', None))
+        self.assertEqual(self.ext.unwrap_validator('"abc"'), (None, None))
+        self.assertEqual(self.ext.unwrap_validator(None), (None, None))
+
+    def test_wrap_validator(self):
+        for value, truncated_at in (('"abc"', None), ('"abc"', 200), ('', None)):
+            wrapped = self.ext.wrap_validator(value, truncated_at)
+            self.assertEqual(self.ext.unwrap_validator(wrapped), (value, truncated_at))
+
+    def _fetch_channel(self, etag, modified, max_episodes=200):
+        channel = mock.Mock(url=CHANNEL_URL, http_etag=etag, http_last_modified=modified)
+        with mock.patch.object(self.ytdl, 'refresh') as refresh:
+            self.ytdl.fetch_channel(channel, max_episodes)
+        return refresh.call_args[0]
+
+    def test_foreign_validators_ignored(self):
+        args = self._fetch_channel('"feedcore"', 'Mon, 01 Jun 2020 00:00:00 GMT')
+        self.assertEqual(args[3:], (None, None, True))
+
+    def test_own_validators_used(self):
+        args = self._fetch_channel('youtube-dl:"etag"', 'youtube-dl:')
+        self.assertEqual(args[3:], ('"etag"', '', True))
+
+    def test_no_check_without_validators(self):
+        args = self._fetch_channel('youtube-dl:', 'youtube-dl:')
+        self.assertEqual(args[3:], ('', '', False))
+
+    def test_check_when_channel_fully_listed(self):
+        # a small channel, listed to the end last time
+        args = self._fetch_channel('youtube-dl:"etag"', None, max_episodes=200)
+        self.assertEqual(args[3:], ('"etag"', None, True))
+
+    def test_check_when_no_more_episodes_wanted(self):
+        args = self._fetch_channel('youtube-dl[200]:"etag"', 'youtube-dl[200]:', max_episodes=100)
+        self.assertEqual(args[3:], ('"etag"', '', True))
+
+    def test_no_check_when_more_episodes_wanted(self):
+        args = self._fetch_channel('youtube-dl[100]:"etag"', None, max_episodes=200)
+        self.assertEqual(args[3:], ('"etag"', None, False))
+        args = self._fetch_channel(None, 'youtube-dl[100]:modified', max_episodes=0)
+        self.assertEqual(args[3:], (None, 'modified', False))
+
+
+class FakeDownloader:
+    """ refresh_entries fails for the video ids in failing_ids """
+    def __init__(self, failing_ids=()):
+        self.failing_ids = failing_ids
+
+    def refresh_entries(self, ie_result, max_episodes):
+        ie_result['entries'] = [e if e['id'] in self.failing_ids else
+                                dict(e, webpage_url='https://www.youtube.com/watch?v=' + e['id'])
+                                for e in ie_result['entries']]
+
+
+class TestYoutubeFeedValidators(YoutubeDLTestCase):
+    def setUp(self):
+        super().setUp()
+        self.channel = mock.Mock()
+
+    def _feed(self, downloader, max_episodes=0):
+        entries = [{'_type': 'url', 'ie_key': 'Youtube', 'id': video_id, 'title': video_id}
+                   for video_id in ('a', 'b', 'c')]
+        return self.ext.YoutubeFeed(CHANNEL_URL, None, '', max_episodes, {'entries': entries}, downloader,
+                                    http_etag='"etag"', http_last_modified='')
+
+    def test_validators_exposed(self):
+        feed = self._feed(FakeDownloader())
+        episodes, seen_guids = feed.get_new_episodes(self.channel, {})
+        self.assertEqual(len(episodes), 3)
+        self.assertEqual(feed.get_http_etag(), 'youtube-dl:"etag"')
+        self.assertEqual(feed.get_http_last_modified(), 'youtube-dl:')
+
+    def test_validators_record_truncated_listing(self):
+        feed = self._feed(FakeDownloader(), max_episodes=2)
+        episodes, seen_guids = feed.get_new_episodes(self.channel, {})
+        self.assertEqual(len(episodes), 2)
+        self.assertEqual(feed.get_http_etag(), 'youtube-dl[2]:"etag"')
+        self.assertEqual(feed.get_http_last_modified(), 'youtube-dl[2]:')
+
+    def test_validators_withheld_when_entries_skipped(self):
+        feed = self._feed(FakeDownloader(failing_ids=('b',)))
+        episodes, seen_guids = feed.get_new_episodes(self.channel, {'yt:video:a': None})
+        self.assertEqual(len(episodes), 1)
+        self.assertEqual(len(seen_guids), 3)
+        self.assertIsNone(feed.get_http_etag())
+        self.assertIsNone(feed.get_http_last_modified())
+
+
+class TestYoutubeDLRefreshEntries(YoutubeDLTestCase):
+    def test_refresh_entries(self):
+        entries = [{'_type': 'url', 'ie_key': 'Youtube', 'id': video_id} for video_id in 'abcdef']
+        ie_result = {'entries': entries}
+
+        def process_ie_result(ydl, entry, download):
+            if entry['id'] == 'c':
+                raise youtube_dl.utils.DownloadError('throttled')
+            return {'id': entry['id'], 'webpage_url': 'https://www.youtube.com/watch?v=' + entry['id']}
+
+        with mock.patch.object(youtube_dl.YoutubeDL, 'process_ie_result',
+                               autospec=True, side_effect=process_ie_result) as process:
+            self.ytdl.refresh_entries(ie_result, 0)
+        self.assertEqual(process.call_count, 6)
+        # order is kept and a failed entry doesn't prevent the others from being refreshed
+        self.assertEqual([e['id'] for e in ie_result['entries']], list('abcdef'))
+        self.assertEqual([self.ext.entry_is_refreshed(e) for e in ie_result['entries']],
+                         [True, True, False, True, True, True])
+
+
+class TestYoutubeDLRefresh(YoutubeDLTestCase):
+    def test_no_channel_info_when_listing_fails(self):
+        error = youtube_dl.utils.DownloadError('channel not found')
+        with mock.patch.object(youtube_dl.YoutubeDL, 'extract_info', side_effect=error), \
+                mock.patch.object(self.ext.youtube, 'get_cover') as get_cover, \
+                mock.patch.object(self.ext.youtube, 'get_channel_desc') as get_channel_desc:
+            with self.assertRaises(youtube_dl.utils.DownloadError):
+                self.ytdl.refresh('https://www.youtube.com/channel/UCxyz', CHANNEL_URL, 0)
+        self.assertEqual(get_cover.call_count, 0)
+        self.assertEqual(get_channel_desc.call_count, 0)
+
+
+class TestYoutubeDLInstances(YoutubeDLTestCase):
+    def setUp(self):
+        super().setUp()
+        self.idle = []
+
+    def test_concurrent_borrows_get_own_instances(self):
+        with self.ytdl._borrowed_ydl(self.idle, {}) as ydl1:
+            with self.ytdl._borrowed_ydl(self.idle, {}) as ydl2:
+                self.assertIsNot(ydl1, ydl2)
+        self.assertEqual(len(self.idle), 2)
+
+    def test_instances_reused(self):
+        with self.ytdl._borrowed_ydl(self.idle, {}) as ydl1:
+            pass
+        with self.ytdl._borrowed_ydl(self.idle, {}) as ydl2:
+            self.assertIs(ydl1, ydl2)
+
+    def test_close(self):
+        with mock.patch.object(youtube_dl.YoutubeDL, '__exit__', autospec=True) as exit:
+            with self.ytdl._borrowed_ydl(self.ytdl._idle_refresh_ydls, {}) as idle_ydl:
+                pass
+            with self.ytdl._borrowed_ydl(self.ytdl._idle_entries_ydls, {}) as busy_ydl:
+                self.ytdl.close()
+                exit.assert_called_once_with(idle_ydl, None, None, None)
+            # closed when given back
+            exit.assert_called_with(busy_ydl, None, None, None)
+        self.assertEqual(self.ytdl._idle_entries_ydls, [])
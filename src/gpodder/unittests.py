@@ -67,6 +67,14 @@ for module in test_modules:
     suite.addTest(unittest.defaultTestLoader.loadTestsFromModule(test_mod))
     coverage_modules.append(coverage_mod)
 
+# Unit tests (in gpodder.test) for code outside of the gpodder package
+# ex: Tests for share/gpodder/extensions/youtube-dl.py are in "gpodder.test.youtubedl"
+extension_test_modules = ['youtubedl']
+
+for module in extension_test_modules:
+    test_mod = __import__('.'.join((test_package, module)), fromlist=[module])
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromModule(test_mod))
+
 try:
     # If you want a HTML-based test report, install HTMLTestRunner from:
     # http://tungwaiyip.info/software/HTMLTestRunner.html
@@ -31,6 +31,7 @@ are not tied to any specific part of gPodder.
 """
 import collections
 import datetime
+import functools
 import glob
 import gzip
 import http.client
@@ -862,6 +863,7 @@ def extension_from_mimetype(mimetype):
     return mimetypes.guess_extension(mimetype) or ''
 
 
+@functools.lru_cache(maxsize=32)
 def mimetype_from_extension(extension):
     """
     Simply guesses what the mimetype should be from the file extension